@@ -7,6 +7,7 @@ import os
 from netCDF4 import Dataset as netCDFFile
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+import cartopy
 import cartopy.crs as ccrs
 
 from cartopy.mpl.gridliner import LATITUDE_FORMATTER, LONGITUDE_FORMATTER
@@ -17,6 +18,10 @@ from math import ceil
 
 import glob
 import contextlib
+import hashlib
+import shutil
+import tempfile
+import time
 from PIL import Image
 import re
 
@@ -39,6 +44,28 @@ params = {
 # The PERSIANN timestep from download (number of hours in each window).
 timestep = 3
 
+# Value used by the CHRS data portal for missing cells (see info.txt).
+NODATA_value = -99
+
+# Number of contour levels shared by every frame, and the resolution (mm) of
+# the global histogram the levels are picked from.
+num_levels = 60
+level_resolution = 0.1
+
+# Rendering mode: "vector" redraws every layer of every frame, "composite"
+# rasterizes the static layers (map, grid lines, colorbar, histogram) once and
+# draws only the precipitation field and the current histogram bar per frame.
+render_mode = "vector"
+
+# Directory where the rasterized static layers are cached between runs, and
+# the number of cached layers kept there.
+cache_dir = os.path.join("out", ".cache")
+max_cached_layers = 8
+layer_cache = {}
+
+# Size of each figure in inches.
+figure_size = (14, 4)
+
 
 def read_NCDF4(filename):
     dataset = netCDFFile(filename, "r")
@@ -52,49 +79,81 @@ def read_NCDF4(filename):
     return (lon, lat, datetime, precip)
 
 
-def plot_data(filename, params):
-    data_lon, data_lat, data_datetime, data_precip = read_NCDF4(filename)
+def compute_levels(precip, num_levels=num_levels, resolution=level_resolution):
+    # Go through the precipitation one window at a time and build a global
+    # value histogram, ignoring masked and NODATA cells. The contour levels are
+    # the quantiles of that histogram so that every frame shares the same levels.
+    counts = np.zeros(1, dtype=np.int64)
+    for window in range(len(precip)):
+        values = np.ma.masked_values(precip[window, :, :], NODATA_value).compressed()
+        bins = np.floor(np.maximum(values, 0) / resolution).astype(np.int64)
+        window_counts = np.bincount(bins)
+        if len(window_counts) > len(counts):
+            counts = np.pad(counts, (0, len(window_counts) - len(counts)))
+        counts[: len(window_counts)] += window_counts
+
+    # Upper edge of the histogram bin holding each quantile.
+    cdf = np.cumsum(counts)
+    quantiles = np.linspace(0, 1, num_levels)[1:] * cdf[-1]
+    edges = (np.searchsorted(cdf, quantiles) + 1) * resolution
+    levels = np.unique(np.concatenate(([0], edges)))
+    if len(levels) < 2:
+        levels = np.array([0, resolution])
+
+    norm = mpl.colors.BoundaryNorm(levels, mpl.cm.plasma.N)
+
+    return (levels, norm)
+
+
+def map_title(params, window):
+    return (
+        params["Title"]
+        + f" ({(window * timestep * 60 * 60)}-{(window + 1) * timestep * 60 * 60} sec UTC)"
+    )
 
-    # Grab the start date for the data from the user
-    start_date = input(
-        "Enter start date for the date (MM/DD) or press enter if this value is unknown: "
+
+def figure_path(params, window):
+    return os.path.join(
+        "out",
+        params["Output-dir-name"],
+        f"[{window}] {params['Date']}_{window * timestep}_{(window + 1) * timestep}",
     )
-    if start_date:
-        start_date = dt.datetime.strptime(start_date, "%m/%d")
 
-    # Calculate data for the histogram.
-    precip_sums = [
-        np.array(data_precip[window, :, :]).sum() for window in range(len(data_precip))
-    ]
-    total_precip = sum(precip_sums)
 
-    times = [window * timestep * 60 * 60 for window in range(len(data_precip))]
-    num_days = int((len(times) * timestep) / 24)
+def create_figure(
+    data_lon,
+    data_lat,
+    norm,
+    times,
+    precip_sums,
+    total_precip,
+    num_days,
+    start_date,
+    draw_map=True,
+):
+    # Create figure with the layers that are the same for every window. The
+    # county boundaries and grid lines are left out with `draw_map=False`
+    # when they are already rasterized.
+    fig = plt.figure(figsize=figure_size)
+    ax1 = fig.add_subplot(1, 2, 1, projection=ccrs.PlateCarree())
+    ax2 = fig.add_subplot(1, 2, 2)
+
+    ax1.set_extent(
+        [
+            data_lon[0],
+            data_lon[-1],
+            data_lat[0],
+            data_lat[-1],
+        ],  # map region boundaries.
+        crs=ccrs.PlateCarree(),
+    )
 
-    # Plot data for each window.
-    for window in range(len(data_precip)):
-        # Create figure
-        fig = plt.figure(figsize=(14, 4))
-        ax1 = fig.add_subplot(1, 2, 1, projection=ccrs.PlateCarree())
-        ax2 = fig.add_subplot(1, 2, 2)
-        # Create contour plot
-        ax1.set_title(
-            params["Title"]
-            + f" ({(window * timestep * 60 * 60)}-{(window + 1) * timestep * 60 * 60} sec UTC)"
-        )
+    map_layers = []
+    if draw_map:
         shape = ShapelyFeature(
             Reader(shp_name).geometries(), ccrs.PlateCarree(), facecolor="none"
         )
-        ax1.add_feature(shape)
-        ax1.set_extent(
-            [
-                data_lon[0],
-                data_lon[-1],
-                data_lat[0],
-                data_lat[-1],
-            ],  # map region boundaries.
-            crs=ccrs.PlateCarree(),
-        )
+        feature = ax1.add_feature(shape)
 
         # Creating grid lines
         grid_lines = ax1.gridlines(crs=ccrs.PlateCarree(), draw_labels=True)
@@ -103,78 +162,330 @@ def plot_data(filename, params):
         grid_lines.xformatter = LONGITUDE_FORMATTER
         grid_lines.yformatter = LATITUDE_FORMATTER
 
-        ax1.contourf(
-            data_lon,
-            data_lat,
-            data_precip[window, :, :],
-            60,
-            cmap="plasma",
-            transform=ccrs.PlateCarree(),
-        )
+        map_layers = [feature, grid_lines, ax1.spines["geo"]]
 
-        # Add colorbar
-        cmap = mpl.cm.plasma
-        bounds = [0, 10, 20, 30, 40, 50]
-        plt.colorbar(
-            mappable=mpl.cm.ScalarMappable(
-                norm=mpl.colors.BoundaryNorm(bounds, cmap.N, extend="both"), cmap=cmap
-            ),
-            ax=ax1,
-        )
+    # Add colorbar (same levels and norm as every frame's contour plot)
+    plt.colorbar(
+        mappable=mpl.cm.ScalarMappable(norm=norm, cmap=mpl.cm.plasma),
+        ax=ax1,
+    )
 
-        # Create histogram
-        ax2.set_title(
-            "Proportion of Percipitation over Time (Red Indicates Current Window)"
-        )
-        ax2.set_ylabel("Proportion of Precipitation")
+    # Create histogram
+    ax2.set_title(
+        "Proportion of Percipitation over Time (Red Indicates Current Window)"
+    )
+    ax2.set_ylabel("Proportion of Precipitation")
 
-        n, bins, patches = ax2.hist(
-            times, bins=len(times), weights=precip_sums / total_precip
+    n, bins, patches = ax2.hist(
+        times, bins=len(times), weights=precip_sums / total_precip
+    )
+    if num_days <= 2:
+        ax2.set_xticks(
+            np.arange(0, max(times), 3600 * 6),
+            [f"{i}:00" for i in range(0, int(max(times) / 3600), 6)],
         )
-        patches[window].set_facecolor("red")
-        if num_days <= 2:
+        ax2.set_xlabel("Time Elapsed (Hours)")
+    else:
+        step = ceil(num_days / 9)
+        days = list(range(0, num_days, step))
+        if start_date:
             ax2.set_xticks(
-                np.arange(0, max(times), 3600 * 6),
-                [f"{i}:00" for i in range(0, int(max(times) / 3600), 6)],
+                np.arange(0, max(times), 3600 * 24 * step),
+                [
+                    (start_date + dt.timedelta(days=i)).strftime("%m/%d")
+                    for i in days
+                ],
             )
-            ax2.set_xlabel("Time Elapsed (Hours)")
+            ax2.set_xlabel("Date")
         else:
-            step = ceil(num_days / 9)
-            days = list(range(0, num_days, step))
-            if start_date:
-                ax2.set_xticks(
-                    np.arange(0, max(times), 3600 * 24 * step),
-                    [
-                        (start_date + dt.timedelta(days=i)).strftime("%m/%d")
-                        for i in days
-                    ],
-                )
-                ax2.set_xlabel("Date")
-            else:
-                ax2.set_xticks(
-                    np.arange(0, max(times), 3600 * 24 * step),
-                    [f"Day {i}" for i in days],
-                )
-                ax2.set_xlabel("Time Elapsed (Days)")
-
-        # Generating the necessary directories.
-        if not os.path.exists(os.path.join("out", params["Output-dir-name"])):
-            os.mkdir(os.path.join("out", params["Output-dir-name"]))
-        if not os.path.exists("out"):
-            os.mkdir("out")
-
-        fig.tight_layout()
-
-        figure_out = os.path.join(
-            "out",
-            params["Output-dir-name"],
-            f"[{window}] {params['Date']}_{window * timestep}_{(window + 1) * timestep}",
+            ax2.set_xticks(
+                np.arange(0, max(times), 3600 * 24 * step),
+                [f"Day {i}" for i in days],
+            )
+            ax2.set_xlabel("Time Elapsed (Days)")
+
+    return (fig, ax1, ax2, patches, map_layers)
+
+
+def plot_precip(ax1, data_lon, data_lat, precip, levels, norm):
+    # Create contour plot
+    return ax1.contourf(
+        data_lon,
+        data_lat,
+        np.ma.masked_values(precip, NODATA_value),
+        levels=levels,
+        cmap="plasma",
+        norm=norm,
+        transform=ccrs.PlateCarree(),
+    )
+
+
+def layers_key(params, data_lon, data_lat, levels, precip_sums, start_date):
+    # Everything the static layers depend on: extent, figure size and dpi, the
+    # data shown in the colorbar and histogram, the shapefile and the libraries.
+    shp_stat = os.stat(shp_name)
+    key = (
+        (data_lon[0], data_lon[-1], data_lat[0], data_lat[-1]),
+        figure_size,
+        mpl.rcParams["figure.dpi"],
+        params["Title"],
+        tuple(levels),
+        tuple(precip_sums),
+        start_date,
+        (shp_name, shp_stat.st_mtime_ns, shp_stat.st_size),
+        (mpl.__version__, cartopy.__version__),
+        sorted(mpl.rcParams.items()),
+    )
+
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def load_layers(digest):
+    # Look the static layers up in memory, then on disk.
+    cache_file = os.path.join(cache_dir, f"layers-{digest}.npz")
+
+    if digest not in layer_cache and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            layer_cache[digest] = (
+                Image.fromarray(cached["underlay"]),
+                Image.fromarray(cached["overlay"]),
+                tuple(cached["crop"]),
+                cached["layout"],
+            )
+        os.utime(cache_file)
+
+    return layer_cache.get(digest)
+
+
+def rasterize_layers(fig, ax1, ax2, map_layers, digest, placeholder_title):
+    # Rasterize the static layers and cache them with the layout needed to
+    # draw the frames without laying out the figure again. The underlay holds
+    # everything drawn below the precipitation field, the overlay holds the
+    # county boundaries, grid lines and map border drawn above it.
+    ax1.set_title(placeholder_title)
+    fig.tight_layout()
+    fig.canvas.draw()
+
+    # Crop box matching `bbox_inches="tight"` of the vector render.
+    renderer = fig.canvas.get_renderer()
+    bbox = fig.get_tightbbox(renderer).padded(mpl.rcParams["savefig.pad_inches"])
+    height = fig.canvas.get_width_height()[1]
+    left = round(bbox.x0 * fig.dpi)
+    top = round(height - bbox.y1 * fig.dpi)
+    crop = (
+        left,
+        top,
+        left + int(bbox.width * fig.dpi),
+        top + int(bbox.height * fig.dpi),
+    )
+
+    ax1.set_title("")
+    for layer in map_layers:
+        layer.set_animated(True)
+    fig.canvas.draw()
+    underlay = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).crop(crop)
+
+    renderer.clear()
+    for layer in map_layers:
+        ax1.draw_artist(layer)
+        layer.set_animated(False)
+    overlay = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).crop(crop)
+
+    layout = np.array(
+        [
+            ax1.get_position().bounds,
+            ax2.get_position().bounds,
+            ax1.get_xlim() + ax1.get_ylim(),
+            ax2.get_xlim() + ax2.get_ylim(),
+            tuple(ax1.title.get_position()) + (0, 0),
+        ]
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez_compressed(
+        os.path.join(cache_dir, f"layers-{digest}.npz"),
+        underlay=np.asarray(underlay),
+        overlay=np.asarray(overlay),
+        crop=crop,
+        layout=layout,
+    )
+
+    # Only keep the most recently used layers on disk.
+    cached_files = sorted(
+        glob.glob(os.path.join(cache_dir, "layers-*.npz")), key=os.path.getmtime
+    )
+    for cached_file in cached_files[:-max_cached_layers]:
+        os.remove(cached_file)
+
+    layer_cache[digest] = (underlay, overlay, crop, layout)
+
+    return layer_cache[digest]
+
+
+def restore_layout(ax1, ax2, layout):
+    # Put the axes where they were when the static layers were rasterized.
+    ax1.set_position(layout[0])
+    ax2.set_position(layout[1])
+    ax1.set_xlim(layout[2][:2])
+    ax1.set_ylim(layout[2][2:])
+    ax2.set_xlim(layout[3][:2])
+    ax2.set_ylim(layout[3][2:])
+    ax1.title.set_position(layout[4][:2])
+
+    # The map background is the clip path of the precipitation field and is
+    # only clipped to the map extent when drawn.
+    ax1.draw_artist(ax1.patch)
+
+
+def render_frames(filename, params, start_date=None, mode=None, windows=None):
+    data_lon, data_lat, data_datetime, data_precip = read_NCDF4(filename)
+    levels, norm = compute_levels(data_precip)
+
+    if mode is None:
+        mode = render_mode
+    if windows is None:
+        windows = range(len(data_precip))
+    windows = [window for window in windows if window < len(data_precip)]
+
+    # Calculate data for the histogram.
+    precip_sums = [
+        np.array(data_precip[window, :, :]).sum() for window in range(len(data_precip))
+    ]
+    total_precip = sum(precip_sums)
+
+    times = [window * timestep * 60 * 60 for window in range(len(data_precip))]
+    num_days = int((len(times) * timestep) / 24)
+
+    figure_args = (
+        data_lon,
+        data_lat,
+        norm,
+        times,
+        precip_sums,
+        total_precip,
+        num_days,
+        start_date,
+    )
+
+    setup_time = 0
+    if mode == "composite":
+        setup_start = time.perf_counter()
+        digest = layers_key(
+            params, data_lon, data_lat, levels, precip_sums, start_date
+        )
+        layers = load_layers(digest)
+        fig, ax1, ax2, patches, map_layers = create_figure(
+            *figure_args, draw_map=layers is None
         )
+        if layers is None:
+            layers = rasterize_layers(
+                fig,
+                ax1,
+                ax2,
+                map_layers,
+                digest,
+                map_title(params, len(data_precip) - 1),
+            )
+        underlay, overlay, crop, layout = layers
+        restore_layout(ax1, ax2, layout)
+        renderer = fig.canvas.get_renderer()
+        setup_time = time.perf_counter() - setup_start
 
-        fig.savefig(figure_out, bbox_inches="tight")
-        plt.close()
+    # Plot data for each window.
+    frame_times = []
+    for window in windows:
+        frame_start = time.perf_counter()
+        figure_out = figure_path(params, window)
+
+        if mode == "composite":
+            # Draw only the layers that change onto a transparent canvas and
+            # composite them between the cached underlay and overlay.
+            renderer.clear()
+            ax1.set_title(map_title(params, window))
+            contour = plot_precip(
+                ax1, data_lon, data_lat, data_precip[window, :, :], levels, norm
+            )
+            ax1.draw_artist(contour)
+            ax1.draw_artist(ax1.title)
+
+            facecolor = patches[window].get_facecolor()
+            patches[window].set_facecolor("red")
+            ax2.draw_artist(patches[window])
+            patches[window].set_facecolor(facecolor)
+            contour.remove()
+
+            frame = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).crop(crop)
+            frame = Image.alpha_composite(underlay, frame)
+            Image.alpha_composite(frame, overlay).save(figure_out + ".png")
+        else:
+            fig, ax1, ax2, patches, map_layers = create_figure(*figure_args)
+            ax1.set_title(map_title(params, window))
+            plot_precip(
+                ax1, data_lon, data_lat, data_precip[window, :, :], levels, norm
+            )
+            patches[window].set_facecolor("red")
+
+            fig.tight_layout()
+            fig.savefig(figure_out, bbox_inches="tight")
+            plt.close()
+
+        frame_times.append(time.perf_counter() - frame_start)
         print(f"Saved figure {figure_out}.")
 
+    if mode == "composite":
+        plt.close()
+
+    return (frame_times, setup_time)
+
+
+def plot_data(filename, params):
+    # Grab the start date for the data from the user
+    start_date = input(
+        "Enter start date for the date (MM/DD) or press enter if this value is unknown: "
+    )
+    if start_date:
+        start_date = dt.datetime.strptime(start_date, "%m/%d")
+
+    # Generating the necessary directories.
+    os.makedirs(os.path.join("out", params["Output-dir-name"]), exist_ok=True)
+
+    render_frames(filename, params, start_date)
+
+
+def benchmark_render(filename, params, num_frames=10):
+    # Compare the per-frame time of the full vector render against the
+    # composite render. The composite runs use an empty temporary cache: the
+    # first one rasterizes the static layers and the second one, with the
+    # in-memory cache cleared, reads them from disk. The frames are written to
+    # out/benchmark/<mode> to be compared side by side.
+    global cache_dir
+    user_cache_dir = cache_dir
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        for mode, dir_name in (
+            ("vector", "vector"),
+            ("composite", "composite"),
+            ("composite", "composite-cached"),
+        ):
+            layer_cache.clear()
+            bench_params = dict(params)
+            bench_params["Output-dir-name"] = os.path.join("benchmark", dir_name)
+            os.makedirs(
+                os.path.join("out", bench_params["Output-dir-name"]), exist_ok=True
+            )
+
+            frame_times, setup_time = render_frames(
+                filename, bench_params, mode=mode, windows=range(num_frames)
+            )
+            print(
+                f"{dir_name}: {np.mean(frame_times):.3f} s per frame over "
+                f"{len(frame_times)} frames, {setup_time:.3f} s of setup."
+            )
+    finally:
+        shutil.rmtree(cache_dir)
+        cache_dir = user_cache_dir
+
 
 def generate_gif(image_dir, output_file, frame_duration=0.3):
     with contextlib.ExitStack() as stack: